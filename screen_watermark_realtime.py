@@ -7,6 +7,7 @@
 import sys
 import os
 import time
+import queue
 import threading
 import numpy as np
 import cv2
@@ -27,126 +28,235 @@ class RealtimeScreenWatermark:
         self.device_id = device_id
         self.session_id = session_id
         self.embedder = WatermarkEmbedder(device_id, session_id)
+        # 帧尺寸和强度整个会话固定, 预编译全帧增量矩阵
+        self.embedder.compile_for((720, 1280), strength=1.0)
         self.detector = WatermarkDetector()
         self.running = False
         self.screenshot_path = 'realtime_screenshot.png'
         self.watermarked_path = 'realtime_watermarked.png'
-        
-    def create_frame(self, frame_num, width=1280, height=720):
-        """创建单帧内容"""
-        img = Image.new('RGB', (width, height), color='white')
-        draw = ImageDraw.Draw(img)
-        
+        self._load_fonts()
+        self._bg = None  # 静态背景缓存 (按帧尺寸惰性构建)
+
+        # 后台写盘线程: PNG 编码 (deflate) 会阻塞显示循环几十毫秒,
+        # 截屏帧交给队列异步落盘
+        self._write_queue = queue.Queue()
+        self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer_thread.start()
+
+    def _writer_loop(self):
+        """写盘线程: 从队列取 (路径, 帧, 编码参数) 并保存"""
+        while True:
+            path, frame, params = self._write_queue.get()
+            cv2.imwrite(path, frame, params)
+            print(f"✓ 截屏已保存: {path}")
+
+    def _load_fonts(self):
+        """加载字体并缓存 (避免每帧重复读取字体文件)"""
         try:
-            font_large = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 48)
-            font_medium = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 32)
-            font_small = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 20)
+            self.font_large = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 48)
+            self.font_medium = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 32)
+            self.font_small = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 20)
         except:
-            font_large = ImageFont.load_default()
-            font_medium = ImageFont.load_default()
-            font_small = ImageFont.load_default()
-        
+            self.font_large = ImageFont.load_default()
+            self.font_medium = ImageFont.load_default()
+            self.font_small = ImageFont.load_default()
+
+    def _build_background(self, width, height):
+        """用 PIL 渲染一次静态背景 (中文文本只在这里栅格化)
+
+        帧全程保持单通道灰度 ('L' 模式), 嵌入前无需再做颜色转换;
+        文字颜色用不同灰度等级区分 (0=黑, 255=白)
+        """
+        img = Image.new('L', (width, height), color=255)
+        draw = ImageDraw.Draw(img)
+
         # 标题
-        draw.text((50, 50), "实时屏幕水印系统", fill='black', font=font_large)
-        
-        # 内容
+        draw.text((50, 50), "实时屏幕水印系统", fill=0, font=self.font_large)
+
+        # 内容 (动态行只绘制中文标签, 数值每帧由 cv2.putText 填充)
         y_pos = 150
-        draw.text((50, y_pos), f"设备 ID: {self.device_id}", fill='blue', font=font_medium)
+        draw.text((50, y_pos), f"设备 ID: {self.device_id}", fill=60, font=self.font_medium)
         y_pos += 80
-        draw.text((50, y_pos), f"会话 ID: {self.session_id}", fill='blue', font=font_medium)
+        draw.text((50, y_pos), f"会话 ID: {self.session_id}", fill=60, font=self.font_medium)
         y_pos += 80
-        draw.text((50, y_pos), f"帧数: {frame_num}", fill='red', font=font_medium)
+        draw.text((50, y_pos), "帧数:", fill=80, font=self.font_medium)
         y_pos += 80
-        draw.text((50, y_pos), f"时间: {time.strftime('%H:%M:%S')}", fill='green', font=font_medium)
+        draw.text((50, y_pos), "时间:", fill=100, font=self.font_medium)
         y_pos += 80
-        draw.text((50, y_pos), "此屏幕已嵌入不可见的数字水印", fill='darkgreen', font=font_medium)
-        
+        draw.text((50, y_pos), "此屏幕已嵌入不可见的数字水印", fill=90, font=self.font_medium)
+
         # 底部信息
-        draw.text((50, height - 100), 
-                 "按 'q' 键截屏并识别水印 | 按 'ESC' 退出", 
-                 fill='gray', font=font_small)
-        
+        draw.text((50, height - 100),
+                 "按 'q' 键截屏并识别水印 | 按 'ESC' 退出",
+                 fill=128, font=self.font_small)
+
         return np.array(img)
+
+    def create_frame(self, frame_num, width=1280, height=720):
+        """创建单帧内容 (复制缓存背景, 只绘制动态数值)"""
+        if self._bg is None or self._bg.shape[:2] != (height, width):
+            self._bg = self._build_background(width, height)
+
+        img = self._bg.copy()
+
+        # cv2.putText 不支持中文, 中文标签已预渲染在背景里, 这里只画 ASCII 数值
+        cv2.putText(img, str(frame_num), (165, 342),
+                    cv2.FONT_HERSHEY_SIMPLEX, 1.0, 80, 2)
+        cv2.putText(img, time.strftime('%H:%M:%S'), (165, 422),
+                    cv2.FONT_HERSHEY_SIMPLEX, 1.0, 100, 2)
+
+        return img
     
     def embed_watermark_on_frame(self, frame):
-        """在帧上嵌入水印"""
-        # 转换为灰度
+        """在帧上嵌入水印 (帧已是单通道灰度, 直接嵌入)"""
         if len(frame.shape) == 3:
-            gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-        else:
-            gray = frame
-        
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+
         # 嵌入不可见水印 (强度 1.0 = 不可见, PSNR > 40 dB)
-        watermarked = self.embedder.embed(gray, strength=1.0)
-        
-        # 转换回彩色
-        watermarked_color = cv2.cvtColor(watermarked, cv2.COLOR_GRAY2RGB)
-        
-        return watermarked_color, watermarked
+        # 预编译尺寸的帧走专用快速路径
+        if frame.shape == self.embedder._compiled_shape:
+            return self.embedder.embed_fast(frame)
+        return self.embedder.embed(frame, strength=1.0)
     
-    def run_realtime(self, duration=30):
-        """运行实时水印系统"""
+    @staticmethod
+    def _put_latest(q, item):
+        """向有界队列放入新帧, 队列满时丢弃最旧的一帧 (流水线不阻塞)"""
+        while True:
+            try:
+                q.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _frame_producer(self, stop_event, frame_queue):
+        """生产者线程: 持续渲染新帧"""
+        frame_num = 0
+        while not stop_event.is_set():
+            frame = self.create_frame(frame_num)
+            self._put_latest(frame_queue, frame)
+            frame_num += 1
+
+    # 批量嵌入的帧数上限 (约束显示路径的额外延迟)
+    EMBED_BATCH_MAX = 4
+
+    def _embed_worker(self, stop_event, frame_queue, display_queue):
+        """嵌入线程: 从渲染队列取帧, 嵌入水印后送入显示队列
+
+        队列有积压时把最多 EMBED_BATCH_MAX 帧合成一个 (N, H, W)
+        张量做一次广播嵌入, 减少逐帧派发开销
+        """
+        while not stop_event.is_set():
+            try:
+                frames = [frame_queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            while len(frames) < self.EMBED_BATCH_MAX:
+                try:
+                    frames.append(frame_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            compiled = self.embedder._compiled_shape
+            if len(frames) > 1 and all(f.shape == compiled for f in frames):
+                for watermarked in self.embedder.embed_fast_batch(frames):
+                    self._put_latest(display_queue, watermarked)
+            else:
+                for frame in frames:
+                    self._put_latest(display_queue,
+                                     self.embed_watermark_on_frame(frame))
+
+    def run_realtime(self, duration=30, target_fps=30):
+        """运行实时水印系统 (渲染 → 嵌入 → 显示 三级流水线)
+
+        Args:
+            duration: 运行时间 (秒)
+            target_fps: 目标显示帧率, waitKey 延时按每帧实际耗时自适应
+        """
         print("\n" + "╔" + "="*58 + "╗")
         print("║" + " "*58 + "║")
         print("║" + "  实时屏幕水印系统".center(58) + "║")
         print("║" + " "*58 + "║")
         print("╚" + "="*58 + "╝")
-        
-        print(f"\n⏱️  运行时间: {duration} 秒")
+
+        print(f"\n⏱️  运行时间: {duration} 秒 | 目标帧率: {target_fps} FPS")
         print("按 'q' 键截屏并识别水印")
         print("按 'ESC' 退出\n")
-        
-        frame_num = 0
-        start_time = time.time()
+
+        # monotonic 时钟不受系统时间跳变影响
+        start_time = time.monotonic()
+        frame_budget_ms = 1000.0 / target_fps
         last_watermarked = None
-        
+
+        # 有界队列连接三级流水线: 渲染与嵌入在后台线程并行,
+        # 显示 (cv2.imshow/waitKey) 必须保持在主线程
+        stop_event = threading.Event()
+        frame_queue = queue.Queue(maxsize=2)
+        display_queue = queue.Queue(maxsize=2)
+
+        producer = threading.Thread(
+            target=self._frame_producer,
+            args=(stop_event, frame_queue), daemon=True)
+        embedder = threading.Thread(
+            target=self._embed_worker,
+            args=(stop_event, frame_queue, display_queue), daemon=True)
+        producer.start()
+        embedder.start()
+
         try:
             while True:
                 # 检查是否超时
-                if time.time() - start_time > duration:
+                if time.monotonic() - start_time > duration:
                     print("\n⏱️  时间到，退出演示")
                     break
-                
-                # 创建帧
-                frame = self.create_frame(frame_num)
-                
-                # 嵌入水印
-                watermarked_color, watermarked_gray = self.embed_watermark_on_frame(frame)
+
+                t0 = time.perf_counter()
+
+                # 取最新的带水印帧
+                try:
+                    watermarked_gray = display_queue.get(timeout=1.0)
+                except queue.Empty:
+                    continue
                 last_watermarked = watermarked_gray
-                
-                # 显示帧
-                display_frame = cv2.cvtColor(watermarked_color, cv2.COLOR_RGB2BGR)
+
+                # 显示前做全流水线唯一的一次颜色转换
+                display_frame = cv2.cvtColor(watermarked_gray, cv2.COLOR_GRAY2BGR)
                 cv2.imshow('屏幕水印系统 - 实时演示', display_frame)
-                
-                # 处理按键
-                key = cv2.waitKey(100) & 0xFF
-                
+
+                # 自适应延时: 只睡掉本帧剩余的时间片, 不再固定 100ms 封顶
+                work_ms = (time.perf_counter() - t0) * 1000.0
+                delay = max(1, int(frame_budget_ms - work_ms))
+                key = cv2.waitKey(delay) & 0xFF
+
                 if key == ord('q'):
-                    # 截屏
+                    # 截屏 (异步写盘; 压缩等级 1, 临时文件不必追求压缩率)
                     print("\n📸 截屏...")
-                    cv2.imwrite(self.watermarked_path, display_frame)
-                    print(f"✓ 截屏已保存: {self.watermarked_path}")
-                    
+                    self._write_queue.put((self.watermarked_path, display_frame.copy(),
+                                           [cv2.IMWRITE_PNG_COMPRESSION, 1]))
+
                     # 识别水印
                     print("\n🔍 识别水印...")
                     result = self.detector.detect(last_watermarked)
-                    
+
                     # 显示结果
                     self.display_detection_result(result)
-                    
+
                     # 继续或退出
                     print("\n按任意键继续，或按 'ESC' 退出...")
                     key = cv2.waitKey(0) & 0xFF
                     if key == 27:  # ESC
                         break
-                
+
                 elif key == 27:  # ESC
                     print("\n👋 退出演示")
                     break
-                
-                frame_num += 1
-        
+
         finally:
+            stop_event.set()
+            producer.join(timeout=1.0)
+            embedder.join(timeout=1.0)
             cv2.destroyAllWindows()
     
     def display_detection_result(self, result):
@@ -183,14 +293,15 @@ def main():
     parser.add_argument('--device-id', default='DEVICE-001', help='设备 ID (≤16字节)')
     parser.add_argument('--session-id', default='SESSION-001', help='会话 ID (≤16字节)')
     parser.add_argument('--duration', type=int, default=30, help='运行时间（秒）')
-    
+    parser.add_argument('--target-fps', type=int, default=30, help='目标显示帧率')
+
     args = parser.parse_args()
-    
+
     system = RealtimeScreenWatermark(
         device_id=args.device_id,
         session_id=args.session_id
     )
-    system.run_realtime(duration=args.duration)
+    system.run_realtime(duration=args.duration, target_fps=args.target_fps)
 
 
 if __name__ == '__main__':
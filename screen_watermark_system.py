@@ -31,29 +31,57 @@ class ScreenWatermarkSystem:
         self.running = False
         self.screenshot_path = 'screen_screenshot.png'
         self.watermarked_screenshot_path = 'screen_watermarked.png'
-        
+        self._load_fonts()
+        # mss 上下文整个生命周期复用 (每次 mss.mss() 都会重新分配显示资源)
+        # 惰性创建: 无显示环境时不在构造函数里抛异常
+        self._sct = None
+        self._monitor = None
+
+    def _load_fonts(self):
+        """加载字体并缓存 (避免每次渲染重复读取字体文件)"""
+        try:
+            self.font_large = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 48)
+            self.font_medium = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 32)
+            self.font_small = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 20)
+        except:
+            self.font_large = ImageFont.load_default()
+            self.font_medium = ImageFont.load_default()
+            self.font_small = ImageFont.load_default()
+
+
+    def _get_sct(self):
+        """获取复用的 mss 截屏上下文 (首次调用时创建)"""
+        if self._sct is None:
+            self._sct = mss.mss()
+            # 获取主屏幕
+            self._monitor = self._sct.monitors[1]
+        return self._sct
+
+    def close(self):
+        """释放截屏资源"""
+        if self._sct is not None:
+            self._sct.close()
+            self._sct = None
+            self._monitor = None
+
     def capture_screen(self):
         """截屏真实屏幕内容"""
         print("\n📸 正在截屏真实屏幕...")
 
         try:
-            with mss.mss() as sct:
-                # 获取主屏幕
-                monitor = sct.monitors[1]
-                screenshot = sct.grab(monitor)
+            sct = self._get_sct()
+            screenshot = sct.grab(self._monitor)
 
-                # 转换为 numpy 数组
-                img = np.array(screenshot)
+            # mss 返回的就是 BGRA, 直接切掉 alpha 通道得到 BGR,
+            # 不做任何颜色转换 (imwrite 本身要求 BGR)
+            img = np.ascontiguousarray(np.asarray(screenshot)[..., :3])
 
-                # 转换 BGRA 到 RGB
-                img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGB)
+            # 保存原始截屏
+            cv2.imwrite(self.screenshot_path, img)
+            print(f"✓ 屏幕截图已保存: {self.screenshot_path}")
+            print(f"  分辨率: {img.shape[1]}x{img.shape[0]}")
 
-                # 保存原始截屏
-                cv2.imwrite(self.screenshot_path, cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
-                print(f"✓ 屏幕截图已保存: {self.screenshot_path}")
-                print(f"  分辨率: {img.shape[1]}x{img.shape[0]}")
-
-                return img
+            return img
         except Exception as e:
             print(f"❌ 截屏失败: {e}")
             print("  使用演示内容代替...")
@@ -67,15 +95,10 @@ class ScreenWatermarkSystem:
         img = Image.new('RGB', (width, height), color='white')
         draw = ImageDraw.Draw(img)
 
-        # 添加文本
-        try:
-            font_large = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 48)
-            font_medium = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 32)
-            font_small = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 20)
-        except:
-            font_large = ImageFont.load_default()
-            font_medium = ImageFont.load_default()
-            font_small = ImageFont.load_default()
+        # 使用缓存的字体
+        font_large = self.font_large
+        font_medium = self.font_medium
+        font_small = self.font_small
 
         # 标题
         draw.text((50, 50), "屏幕水印系统演示", fill='black', font=font_large)
@@ -100,26 +123,24 @@ class ScreenWatermarkSystem:
         img.save(self.screenshot_path)
         print(f"✓ 演示内容已创建: {self.screenshot_path}")
 
-        return np.array(img)
+        # 与截屏路径保持一致, 统一返回 BGR
+        return cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
     
     def embed_watermark(self, image_array):
         """嵌入水印"""
         print("\n🎨 嵌入水印...")
         
-        # 转换为灰度
+        # 转换为灰度 (上游统一传 BGR)
         if len(image_array.shape) == 3:
-            gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
+            gray = cv2.cvtColor(image_array, cv2.COLOR_BGR2GRAY)
         else:
             gray = image_array
-        
+
         # 嵌入不可见水印 (强度 1.0 = 不可见, PSNR > 40 dB)
         watermarked = self.embedder.embed(gray, strength=1.0)
-        
-        # 转换回彩色（为了显示）
-        watermarked_color = cv2.cvtColor(watermarked, cv2.COLOR_GRAY2RGB)
-        
-        # 保存带水印的图像
-        cv2.imwrite(self.watermarked_screenshot_path, cv2.cvtColor(watermarked_color, cv2.COLOR_RGB2BGR))
+
+        # 保存带水印的图像 (灰度图可直接写盘, 无需转回彩色)
+        cv2.imwrite(self.watermarked_screenshot_path, watermarked)
         print(f"✓ 水印已嵌入: {self.watermarked_screenshot_path}")
         
         return watermarked
@@ -200,6 +221,9 @@ class ScreenWatermarkSystem:
             import traceback
             traceback.print_exc()
 
+        finally:
+            self.close()
+
 
 def main():
     """主函数"""
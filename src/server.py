@@ -2,18 +2,72 @@
 简单的 Flask 服务端 API
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from datetime import datetime
 import json
 import os
+import sqlite3
+import threading
 from pathlib import Path
 
+# orjson 序列化比标准库快 2-5 倍, 未安装时回退到 json
+try:
+    import orjson
+
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def _loads(data: bytes) -> dict:
+        return orjson.loads(data)
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+    def _loads(data: bytes) -> dict:
+        return json.loads(data)
+
 app = Flask(__name__)
 
-# 简单的内存数据存储
-devices = {}  # device_id -> device_info
-detections = {}  # detection_id -> detection_info
-detection_counter = 0
+# SQLite (WAL 模式) 存储设备与检测记录:
+# 内存 dict 在多个 gunicorn worker 下各有一份副本, 无法共享;
+# WAL + NORMAL 同步允许读写并发, 自增主键代替需要 GIL 的全局计数器
+# 记录以序列化好的 JSON 字节存储, GET 路径直接返回, 不再重新编码
+DB_PATH = os.environ.get(
+    'WATERMARK_DB', str(Path(__file__).resolve().parent.parent / 'watermark.db'))
+
+_local = threading.local()
+
+
+def _get_db() -> sqlite3.Connection:
+    """获取线程本地的 SQLite 连接"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _local.conn = conn
+    return conn
+
+
+def _init_db():
+    """建表 (幂等)"""
+    conn = _get_db()
+    with conn:
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS devices ('
+            'device_id TEXT PRIMARY KEY, record BLOB NOT NULL)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS detections ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'detection_id TEXT UNIQUE, record BLOB)')
+
+
+_init_db()
+
+
+def _json_response(data: bytes, status: int = 200) -> Response:
+    """直接返回预序列化的 JSON 字节"""
+    return Response(data, status=status, mimetype='application/json')
 
 
 @app.route('/v1/devices/enroll', methods=['POST'])
@@ -34,14 +88,19 @@ def enroll_device():
     if not device_id:
         return jsonify({'error': 'device_id is required'}), 400
     
-    devices[device_id] = {
+    device = {
         'device_id': device_id,
         'device_name': data.get('device_name', ''),
         'location': data.get('location', ''),
         'enrolled_at': datetime.now().isoformat(),
         'status': 'active'
     }
-    
+    conn = _get_db()
+    with conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO devices (device_id, record) VALUES (?, ?)',
+            (device_id, _dumps(device)))
+
     return jsonify({
         'success': True,
         'device_id': device_id,
@@ -52,10 +111,12 @@ def enroll_device():
 @app.route('/v1/devices/<device_id>', methods=['GET'])
 def get_device(device_id):
     """获取设备信息"""
-    if device_id not in devices:
+    row = _get_db().execute(
+        'SELECT record FROM devices WHERE device_id = ?', (device_id,)).fetchone()
+    if row is None:
         return jsonify({'error': 'Device not found'}), 404
-    
-    return jsonify(devices[device_id]), 200
+
+    return _json_response(row[0])
 
 
 @app.route('/v1/sessions', methods=['POST'])
@@ -71,10 +132,12 @@ def create_session():
     """
     data = request.get_json()
     device_id = data.get('device_id')
-    
-    if device_id not in devices:
+
+    row = _get_db().execute(
+        'SELECT 1 FROM devices WHERE device_id = ?', (device_id,)).fetchone()
+    if row is None:
         return jsonify({'error': 'Device not found'}), 404
-    
+
     session_id = f"{device_id}-{datetime.now().timestamp()}"
     
     return jsonify({
@@ -98,32 +161,35 @@ def detect_watermark():
         "confidence": 0.95
     }
     """
-    global detection_counter
-    
     data = request.get_json()
     device_id = data.get('device_id')
     session_id = data.get('session_id')
     payload = data.get('payload')
     confidence = data.get('confidence', 0.0)
-    
+
     if not device_id or not payload:
         return jsonify({'error': 'device_id and payload are required'}), 400
-    
-    detection_counter += 1
-    detection_id = f"DET-{detection_counter:06d}"
-    
-    detection = {
-        'detection_id': detection_id,
-        'device_id': device_id,
-        'session_id': session_id,
-        'payload': payload,
-        'confidence': confidence,
-        'detected_at': datetime.now().isoformat(),
-        'status': 'verified' if confidence > 0.8 else 'pending'
-    }
-    
-    detections[detection_id] = detection
-    
+
+    conn = _get_db()
+    with conn:
+        # 自增主键生成检测编号 (多 worker 下原子, 代替全局计数器)
+        cursor = conn.execute(
+            'INSERT INTO detections (detection_id, record) VALUES (NULL, NULL)')
+        detection_id = f"DET-{cursor.lastrowid:06d}"
+
+        detection = {
+            'detection_id': detection_id,
+            'device_id': device_id,
+            'session_id': session_id,
+            'payload': payload,
+            'confidence': confidence,
+            'detected_at': datetime.now().isoformat(),
+            'status': 'verified' if confidence > 0.8 else 'pending'
+        }
+        conn.execute(
+            'UPDATE detections SET detection_id = ?, record = ? WHERE id = ?',
+            (detection_id, _dumps(detection), cursor.lastrowid))
+
     return jsonify({
         'success': True,
         'detection_id': detection_id,
@@ -136,10 +202,13 @@ def detect_watermark():
 @app.route('/v1/detections/<detection_id>', methods=['GET'])
 def get_detection(detection_id):
     """获取检测结果"""
-    if detection_id not in detections:
+    row = _get_db().execute(
+        'SELECT record FROM detections WHERE detection_id = ?',
+        (detection_id,)).fetchone()
+    if row is None:
         return jsonify({'error': 'Detection not found'}), 404
-    
-    return jsonify(detections[detection_id]), 200
+
+    return _json_response(row[0])
 
 
 @app.route('/v1/reports', methods=['POST'])
@@ -155,17 +224,23 @@ def generate_report():
     data = request.get_json()
     detection_id = data.get('detection_id')
     
-    if detection_id not in detections:
+    conn = _get_db()
+    row = conn.execute(
+        'SELECT record FROM detections WHERE detection_id = ?',
+        (detection_id,)).fetchone()
+    if row is None:
         return jsonify({'error': 'Detection not found'}), 404
-    
-    detection = detections[detection_id]
+
+    detection = _loads(row[0])
     device_id = detection['device_id']
-    
-    if device_id not in devices:
+
+    row = conn.execute(
+        'SELECT record FROM devices WHERE device_id = ?', (device_id,)).fetchone()
+    if row is None:
         return jsonify({'error': 'Device not found'}), 404
-    
-    device = devices[device_id]
-    
+
+    device = _loads(row[0])
+
     report = {
         'report_id': f"RPT-{detection_id}",
         'detection_id': detection_id,
@@ -184,14 +259,21 @@ def generate_report():
 @app.route('/v1/health', methods=['GET'])
 def health_check():
     """健康检查"""
+    conn = _get_db()
+    devices_count = conn.execute('SELECT COUNT(*) FROM devices').fetchone()[0]
+    detections_count = conn.execute('SELECT COUNT(*) FROM detections').fetchone()[0]
+
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'devices_count': len(devices),
-        'detections_count': len(detections)
+        'devices_count': devices_count,
+        'detections_count': detections_count
     }), 200
 
 
 if __name__ == '__main__':
-    app.run(host='127.0.0.1', port=5000, debug=True)
+    # Werkzeug 开发服务器是单线程的, 生产/压测环境请用 gunicorn 部署:
+    #   gunicorn -w 4 -k gthread -b 127.0.0.1:5000 src.server:app
+    print("提示: 生产环境请使用 gunicorn -w 4 -k gthread -b 127.0.0.1:5000 src.server:app")
+    app.run(host='127.0.0.1', port=5000, debug=False, threaded=True)
 
@@ -1,14 +1,16 @@
 """
 水印嵌入与检测核心模块
-实现基础的 DWT + DCT + QIM 水印算法
+实现基于 8x8 块亮度调制的空间域水印算法
 """
 
 import numpy as np
-from scipy import signal
-from scipy.fftpack import dct, idct
-import pywt
-import hashlib
-import struct
+import cv2
+
+try:
+    import watermark_numba as _numba_kernels
+    _HAS_NUMBA = _numba_kernels.NUMBA_AVAILABLE
+except ImportError:
+    _HAS_NUMBA = False
 
 
 class WatermarkEmbedder:
@@ -25,7 +27,14 @@ class WatermarkEmbedder:
         self.device_id = device_id
         self.session_id = session_id
         self.payload = self._create_payload()
-        
+        # 载荷固定, 比特序列只算一次; 符号矩阵按 (bh, bw, strength) 缓存,
+        # 实时场景下帧尺寸不变, 每帧只剩一次加法和裁剪
+        self._bits = self._payload_to_bits()
+        self._sign_cache = {}
+        # compile_for 预编译的全帧增量矩阵 (固定帧尺寸的专用快速路径)
+        self._delta_matrix = None
+        self._compiled_shape = None
+
     def _create_payload(self) -> bytes:
         """创建水印载荷 (32 bytes)"""
         # 格式: device_id(16) + session_id(16)
@@ -34,13 +43,23 @@ class WatermarkEmbedder:
         return device_bytes + session_bytes
     
     def _payload_to_bits(self) -> np.ndarray:
-        """将载荷转换为比特序列"""
-        bits = []
-        for byte in self.payload:
-            for i in range(8):
-                bits.append((byte >> i) & 1)
-        return np.array(bits, dtype=np.float32)
+        """将载荷转换为比特序列 (低位在前)"""
+        return np.unpackbits(np.frombuffer(self.payload, dtype=np.uint8),
+                             bitorder='little').astype(np.float32)
     
+    def _get_signs(self, bh: int, bw: int, strength: float) -> np.ndarray:
+        """获取 (bh, bw) 的 ±strength 符号矩阵 (按帧尺寸和强度缓存)"""
+        key = (bh, bw, strength)
+        signs = self._sign_cache.get(key)
+        if signs is None:
+            # 不可见水印强度: 1.0 对应 ±1 像素变化 (PSNR > 40 dB)
+            n_blocks = bh * bw
+            reps = (n_blocks + len(self._bits) - 1) // len(self._bits)
+            tiled = np.tile(self._bits, reps)[:n_blocks].reshape(bh, bw)
+            signs = (2.0 * tiled - 1.0).astype(np.float32) * strength
+            self._sign_cache[key] = signs
+        return signs
+
     def embed(self, image: np.ndarray, strength: float = 1.0) -> np.ndarray:
         """
         嵌入水印到图像 (LSB + 块平均值方法)
@@ -53,69 +72,101 @@ class WatermarkEmbedder:
         Returns:
             带水印的图像
         """
-        # 转换为灰度图
+        # 转换为灰度图 (cvtColor 全程 uint8 的 SIMD 加权和,
+        # 避免 np.mean 的 uint8→float64 升位)
         if len(image.shape) == 3:
-            image = np.mean(image, axis=2)
-
-        image = image.astype(np.uint8)
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        else:
+            image = image.astype(np.uint8)
         h, w = image.shape
 
-        # 获取比特序列
-        bits = self._payload_to_bits()
-
-        # 直接在空间域嵌入水印
-        watermarked = image.astype(np.float32)
-        bit_index = 0
-
         # 使用 8x8 块进行嵌入
         block_size = 8
-        # 不可见水印强度: 1.0 对应 ±1 像素变化 (PSNR > 40 dB)
-        delta_base = strength
-
-        for i in range(0, h - block_size + 1, block_size):
-            for j in range(0, w - block_size + 1, block_size):
-                bit = int(bits[bit_index % len(bits)])
-                # 获取块
-                block = watermarked[i:i+block_size, j:j+block_size]
-
-                # 根据比特值调整块的所有像素
-                if bit == 1:
-                    # 增加块的亮度
-                    delta = delta_base
-                else:
-                    # 降低块的亮度
-                    delta = -delta_base
-
-                watermarked[i:i+block_size, j:j+block_size] = block + delta
-                bit_index += 1
+        bh, bw = h // block_size, w // block_size
+
+        # 向量化嵌入: 将比特序列平铺到整个块网格, 映射为 ±delta 符号矩阵,
+        # 一次广播加法完成所有块的亮度调制 (避免逐块 Python 循环)
+        signs = self._get_signs(bh, bw, strength)
+
+        # 安装了 numba 时走多线程 SIMD 内核
+        if _HAS_NUMBA:
+            return _numba_kernels.embed_blocks(image, signs)
+
+        watermarked = image.astype(np.float32)
+        # 视图变形为 (bh, 8, bw, 8), 对每个块广播加上符号增量
+        blocks = watermarked[:bh*block_size, :bw*block_size].reshape(
+            bh, block_size, bw, block_size)
+        np.add(blocks, signs[:, None, :, None], out=blocks)
 
         # 裁剪到有效范围
-        result = np.clip(watermarked, 0, 255)
+        np.clip(watermarked, 0, 255, out=watermarked)
 
-        return result.astype(np.uint8)
-    
-    def _embed_in_subband(self, subband: np.ndarray, strength: float) -> np.ndarray:
-        """在子带中嵌入水印"""
-        h, w = subband.shape
-        bits = self._payload_to_bits()
+        return watermarked.astype(np.uint8)
+
+    def compile_for(self, shape: tuple, strength: float = 1.0):
+        """为固定的帧尺寸预编译全帧增量矩阵
+
+        实时场景下 (device_id, session_id, 帧尺寸, 强度) 整个会话不变,
+        把 ±delta 符号矩阵展开成 H×W 的增量矩阵后, 每帧嵌入只剩
+        一次加法和一次裁剪 (见 embed_fast)
+
+        Args:
+            shape: 帧尺寸 (H, W)
+            strength: 水印强度
+        """
+        h, w = shape
+        bh, bw = h // 8, w // 8
+        signs = self._get_signs(bh, bw, strength)
+        delta = np.zeros((h, w), dtype=np.float32)
+        # 每个块的符号增量展开到 8x8 像素 (边缘不完整块保持为 0)
+        delta[:bh*8, :bw*8] = np.kron(signs, np.ones((8, 8), dtype=np.float32))
+        self._delta_matrix = delta
+        # 拆成正/负 uint8 掩码, 配合 cv2.add/subtract 的饱和算术
+        # 全程留在 uint8, 无需 float32 升位也无需显式 clip
+        d = delta.astype(np.int16)
+        self._pos_mask = np.where(d > 0, d, 0).astype(np.uint8)
+        self._neg_mask = np.where(d < 0, -d, 0).astype(np.uint8)
+        self._compiled_shape = (h, w)
+
+    def embed_fast(self, image: np.ndarray) -> np.ndarray:
+        """专用快速嵌入 (仅限 compile_for 预编译过的帧尺寸)
 
-        # 计算子带的标准差用于自适应强度
-        std_val = np.std(subband)
-        adaptive_strength = strength * std_val if std_val > 0 else strength
+        Args:
+            image: 灰度图 (H, W), 尺寸必须与 compile_for 一致
+
+        Returns:
+            带水印的图像
+        """
+        if image.shape != self._compiled_shape:
+            raise ValueError(
+                f"帧尺寸 {image.shape} 与预编译尺寸 {self._compiled_shape} 不一致, "
+                f"请先调用 compile_for")
 
-        # 将比特序列重复平铺以覆盖整个子带
-        bit_index = 0
-        watermark = np.zeros_like(subband, dtype=np.float32)
+        # 饱和加/减法: 每个像素只会命中正掩码或负掩码之一,
+        # 与 float32 加法 + clip 的结果逐像素一致
+        return cv2.subtract(cv2.add(image, self._pos_mask), self._neg_mask)
 
-        for i in range(h):
-            for j in range(w):
-                bit = bits[bit_index % len(bits)]
-                # QIM 量化: 将比特映射到系数
-                # 使用更强的信号: (2*bit - 1) 给出 -1 或 +1
-                watermark[i, j] = (2 * bit - 1) * adaptive_strength
-                bit_index += 1
+    def embed_fast_batch(self, frames) -> np.ndarray:
+        """批量快速嵌入 (仅限 compile_for 预编译过的帧尺寸)
 
-        return subband + watermark
+        把 N 帧堆叠成 (N, H, W) 张量后用一次广播加法嵌入,
+        比逐帧调用少 N-1 次派发, 且大块连续内存对预取更友好
+
+        Args:
+            frames: 帧序列, 每帧为 (H, W) 灰度图
+
+        Returns:
+            带水印的 (N, H, W) uint8 数组
+        """
+        batch = np.stack(frames).astype(np.float32)
+        if batch.shape[1:] != self._compiled_shape:
+            raise ValueError(
+                f"帧尺寸 {batch.shape[1:]} 与预编译尺寸 {self._compiled_shape} 不一致, "
+                f"请先调用 compile_for")
+
+        np.add(batch, self._delta_matrix[None], out=batch)
+        np.clip(batch, 0, 255, out=batch)
+        return batch.astype(np.uint8)
 
 
 class WatermarkDetector:
@@ -135,60 +186,42 @@ class WatermarkDetector:
         Returns:
             检测结果字典
         """
-        # 转换为灰度图
+        # 转换为灰度图 (cvtColor 全程 uint8 的 SIMD 加权和,
+        # 避免 np.mean 的 uint8→float64 升位)
         if len(image.shape) == 3:
-            image = np.mean(image, axis=2)
-
-        image = image.astype(np.uint8)
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        else:
+            image = image.astype(np.uint8)
         h, w = image.shape
 
-        # 直接从空间域提取水印
-        extracted_bits = []
-        block_size = 8
-
         # 只提取前 256 个块（对应 256 比特 = 32 字节）
-        block_count = 0
+        block_size = 8
         max_blocks = 256
 
-        # 第一遍：收集所有块的平均值
-        block_means = []
-        for i in range(0, h - block_size + 1, block_size):
-            for j in range(0, w - block_size + 1, block_size):
-                block = image[i:i+block_size, j:j+block_size]
-                block_means.append(np.mean(block))
-                if len(block_means) >= max_blocks:
-                    break
-            if len(block_means) >= max_blocks:
-                break
-
-        block_means = np.array(block_means[:max_blocks])
+        # 向量化提取: 取按行排列的前 256 个块 (与嵌入顺序一致)
+        # 用 int32 求和代替均值, 避免 uint8→float64 升位;
+        # 中位数阈值与常数除法可交换, 比较结果不变
+        bh, bw = h // block_size, w // block_size
+        if _HAS_NUMBA:
+            sums = _numba_kernels.block_sums(image, bh, bw).ravel()[:max_blocks]
+        else:
+            # 积分图 (summed-area table): 一次 C 级扫描后,
+            # 任意矩形和都是 4 次查表, 也便于后续做网格偏移搜索
+            sat = cv2.integral(image)
+            corners = sat[::block_size, ::block_size]
+            sums = (corners[1:bh+1, 1:bw+1] - corners[:bh, 1:bw+1]
+                    - corners[1:bh+1, :bw] + corners[:bh, :bw]).ravel()[:max_blocks]
 
         # 使用中位数作为阈值（对异常值更鲁棒）
-        global_threshold = np.median(block_means)
-
-        # 第二遍：提取比特
-        block_count = 0
-        for i in range(0, h - block_size + 1, block_size):
-            for j in range(0, w - block_size + 1, block_size):
-                if block_count >= max_blocks:
-                    break
-
-                block = image[i:i+block_size, j:j+block_size]
-                mean_val = np.mean(block)
+        global_threshold = np.median(sums)
 
-                # 使用中位数阈值判断比特
-                bit = 1 if mean_val > global_threshold else 0
-                extracted_bits.append(bit)
-                block_count += 1
+        # 比特判决: 块亮度和高于阈值为 1, 否则为 0
+        extracted_bits = (sums > global_threshold).astype(np.int32)
 
-            if block_count >= max_blocks:
-                break
-
-        # 确保有足够的比特
-        while len(extracted_bits) < 256:
-            extracted_bits.append(0)
-
-        extracted_bits = np.array(extracted_bits[:256], dtype=np.int32)
+        # 帧过小时补零到 256 比特
+        if len(extracted_bits) < max_blocks:
+            extracted_bits = np.pad(extracted_bits,
+                                    (0, max_blocks - len(extracted_bits)))
 
         # 解码载荷
         payload = self._bits_to_payload(extracted_bits)
@@ -211,75 +244,19 @@ class WatermarkDetector:
             'payload': payload.hex()
         }
     
-    def _extract_from_subband(self, subband: np.ndarray) -> np.ndarray:
-        """从子带中提取水印比特"""
-        h, w = subband.shape
-        bits = []
-
-        # 计算子带的平均值作为阈值
-        mean_val = np.mean(subband)
-
-        for i in range(h):
-            for j in range(w):
-                # 软判决: 根据系数与平均值的关系判断比特
-                bit = 1 if subband[i, j] > mean_val else 0
-                bits.append(bit)
-
-        return np.array(bits, dtype=np.int32)
-    
     def _bits_to_payload(self, bits: np.ndarray) -> bytes:
-        """将比特序列转换为载荷"""
+        """将比特序列转换为载荷 (低位在前, 与嵌入端一致)"""
         # 取前 256 比特 (32 bytes)
-        bits = bits[:256]
-
-        payload = bytearray()
-        for i in range(0, len(bits), 8):
-            byte_bits = bits[i:i+8]
-            if len(byte_bits) < 8:
-                byte_bits = np.pad(byte_bits, (0, 8-len(byte_bits)))
-
-            byte_val = 0
-            for j, bit in enumerate(byte_bits):
-                byte_val |= (int(bit) << j)
-
-            payload.append(byte_val)
-
-        return bytes(payload)
-
-    def _extract_with_voting(self, subband: np.ndarray, block_size: int = 8) -> np.ndarray:
-        """使用分块投票的方式提取水印比特"""
-        h, w = subband.shape
-        bits = []
-
-        # 计算子带的平均值作为阈值
-        mean_val = np.mean(subband)
-
-        # 分块处理，确保覆盖整个子带
-        for i in range(0, h, block_size):
-            for j in range(0, w, block_size):
-                # 获取块 (可能不完整)
-                block = subband[i:min(i+block_size, h), j:min(j+block_size, w)]
-                # 计算块内大于平均值的像素比例
-                ratio = np.sum(block > mean_val) / block.size
-                # 投票: 如果大多数像素大于平均值，则为 1
-                bit = 1 if ratio > 0.5 else 0
-                bits.append(bit)
-
-        # 确保有足够的比特 (至少 256 比特用于 32 字节载荷)
-        while len(bits) < 256:
-            bits.append(0)
-
-        return np.array(bits[:256], dtype=np.int32)
-    
+        return np.packbits(bits[:256].astype(np.uint8),
+                           bitorder='little').tobytes()
+
     def _calculate_confidence(self, bits: np.ndarray) -> float:
         """计算检测置信度"""
         # 简单的置信度计算: 比特的一致性
+        # 比特只有 0/1, 多数比特的占比就是 max(mean, 1-mean), 一遍扫描即可
         if len(bits) == 0:
             return 0.0
-        
-        # 计算多数比特
-        majority = np.bincount(bits).argmax()
-        consistency = np.sum(bits == majority) / len(bits)
-        
-        return float(consistency)
+
+        m = float(bits.mean())
+        return max(m, 1.0 - m)
 
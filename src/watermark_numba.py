@@ -0,0 +1,59 @@
+"""
+可选的 Numba JIT 加速内核
+在安装了 numba 的环境中, 嵌入/检测的块级内核会被 LLVM 编译为
+多线程 SIMD 代码 (prange 按块行切分, 内层 8x8 循环自动向量化)
+未安装 numba 时 NUMBA_AVAILABLE 为 False, 调用方回退到纯 NumPy 路径
+"""
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+if NUMBA_AVAILABLE:
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def embed_blocks(image: np.ndarray, signs: np.ndarray) -> np.ndarray:
+        """按块嵌入: 对每个 8x8 块加上带符号的亮度增量并饱和裁剪
+
+        Args:
+            image: 灰度图 (H, W), uint8
+            signs: 每块的增量矩阵 (bh, bw), float32 (已含 ±strength)
+
+        Returns:
+            带水印的 uint8 图像 (边缘不完整块保持不变)
+        """
+        bh, bw = signs.shape
+        out = image.copy()
+        for bi in prange(bh):
+            for bj in range(bw):
+                delta = signs[bi, bj]
+                for i in range(8):
+                    row = bi * 8 + i
+                    for j in range(8):
+                        col = bj * 8 + j
+                        val = image[row, col] + delta
+                        if val < 0.0:
+                            val = 0.0
+                        elif val > 255.0:
+                            val = 255.0
+                        out[row, col] = np.uint8(val)
+        return out
+
+    @njit(parallel=True, cache=True)
+    def block_sums(image: np.ndarray, bh: int, bw: int) -> np.ndarray:
+        """按块求和: 返回 (bh, bw) 的 8x8 块亮度和矩阵 (整数累加, 无浮点升位)"""
+        sums = np.empty((bh, bw), dtype=np.int32)
+        for bi in prange(bh):
+            for bj in range(bw):
+                total = np.int32(0)
+                for i in range(8):
+                    row = bi * 8 + i
+                    for j in range(8):
+                        total += image[row, bj * 8 + j]
+                sums[bi, bj] = total
+        return sums